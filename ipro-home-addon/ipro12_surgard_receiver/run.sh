@@ -1,3 +1,3 @@
 #!/usr/bin/env bash
 cd /app
-python3 surgard.py
+exec python3 surgard.py
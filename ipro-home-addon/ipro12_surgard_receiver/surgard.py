@@ -2,18 +2,32 @@ import socket
 import json
 import os
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timezone
 import threading
 import time
+import argparse
+import bisect
+import mmap
+import struct
+import zlib
+import signal
+import atexit
+import gzip
+import hashlib
+import hmac
+import uuid
+from email.utils import formatdate
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 
 import paho.mqtt.client as mqtt
 import requests
 
-OPTIONS_PATH = "/data/options.json"
-SURGARD_PORT = 6601
-HTTP_PORT = 8124
+# environment overrides allow running several instances on one host
+DATA_DIR = os.environ.get("IPRO12_DATA_DIR", "/data")
+OPTIONS_PATH = os.path.join(DATA_DIR, "options.json")
+SURGARD_PORT = int(os.environ.get("IPRO12_SURGARD_PORT", 6601))
+HTTP_PORT = int(os.environ.get("IPRO12_HTTP_PORT", 8124))
 
 
 def load_options():
@@ -39,12 +53,56 @@ WEBHOOK_ENABLED = bool(opts.get("webhook_enabled", False))
 WEBHOOK_URL = opts.get("webhook_url", "")
 
 ARCHIVE_ENABLED = bool(opts.get("archive_enabled", True))
-DB_PATH = "/data/ipro12_events.db"
+DB_PATH = os.path.join(DATA_DIR, "ipro12_events.db")
+ARCHIVE_RAW = bool(opts.get("archive_raw", False))
+
+CAPTURE_ENABLED = bool(opts.get("capture_enabled", True))
+CAPTURE_PATH = os.path.join(DATA_DIR, "ipro12_capture.bin")
+CAPTURE_MAX_BYTES = int(opts.get("capture_max_mb", 16)) * 1024 * 1024
+CAPTURE_BACKUPS = int(opts.get("capture_backups", 5))
+CAPTURE_BUFFER_SIZE = 64 * 1024
+CAPTURE_FLUSH_INTERVAL = 1
+
+MAX_CONNECTIONS = int(opts.get("max_connections", 16))
+MAX_CONNECTIONS_PER_IP = int(opts.get("max_connections_per_ip", 4))
+CONN_TIMEOUT = float(opts.get("conn_timeout", 10))
+RATE_IP_PER_MIN = float(opts.get("rate_ip_per_min", 60))
+RATE_IP_BURST = int(opts.get("rate_ip_burst", 10))
+RATE_ACCOUNT_PER_MIN = float(opts.get("rate_account_per_min", 60))
+RATE_ACCOUNT_BURST = int(opts.get("rate_account_burst", 10))
+
+REPLICATION_ROLE = opts.get("replication_role", "none").lower()
+REPLICATION_PORT = int(os.environ.get("IPRO12_REPLICATION_PORT", opts.get("replication_port", 6602)))
+REPLICATION_PRIMARY = opts.get("replication_primary", "")
+REPLICATION_SYNC_TIMEOUT = float(opts.get("replication_sync_timeout", 2))
+REPLICATION_SECRET = opts.get("replication_secret", "")
+REPLICATION_LOG_KEEP = 100000
+REPLICATION_PING_INTERVAL = 5
 
 SUPERVISION_TIMEOUT = int(opts.get("supervision_timeout", 300))
 LANG = opts.get("lang", "ru").lower()
 
 DB_CONN = None
+DB_LOCK = threading.Lock()
+# replication: last seq written to the log (primary), last seq applied
+# (standby), and acked seq per connected standby
+REPL_SEQ = 0
+REPL_APPLIED = 0
+REPL_PRIMARY_ID = None
+# a former primary's own log was already streamed, never uplink it
+REPL_UPLINK_FLOOR = 0
+REPL_STANDBYS = {}
+REPL_COND = threading.Condition()
+# random id of this database; standbys resync when their primary's changes
+INSTANCE_ID = None
+# bumped after every commit that changes events; HTTP ETags are derived
+# from it. DATA_EXTERNAL is SQLite's data_version, which moves when another
+# process (replay --archive) commits to the same database.
+DATA_VERSION = 0
+DATA_EXTERNAL = None
+DATA_MODIFIED = time.time()
+BOOT_ID = f"{int(time.time()):x}"
+CAPTURE = None
 STATE_LOCK = threading.Lock()
 LAST_EVENT_TS = datetime.utcnow()
 CONNECTION_STATE = "unknown"
@@ -262,27 +320,233 @@ def get_description(code: str) -> str:
     return ""
 
 
+# Archive schema, tracked in PRAGMA user_version.
+#   0 - legacy: one TEXT column per field, ISO ts, full raw string
+#   2 - ts as epoch ms, numeric code/qualifier/msg_type, account and type
+#       as references into lookup tables, raw optional (zlib blob);
+#       events.replicated marks rows received from a primary,
+#       replication_log holds the events to stream (origin/event_id),
+#       replication_meta the instance id, primary id and seq,
+#       replication_peers the uplink position of each standby on the primary
+SCHEMA_VERSION = 2
+
+LOOKUP_IDS = {"accounts": {}, "event_types": {}}
+
+
+def _create_schema(cur):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS accounts ("
+        "id INTEGER PRIMARY KEY,"
+        "name TEXT UNIQUE NOT NULL"
+        ");"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS event_types ("
+        "id INTEGER PRIMARY KEY,"
+        "name TEXT UNIQUE NOT NULL"
+        ");"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS events ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "ts INTEGER,"
+        "account_id INTEGER REFERENCES accounts(id),"
+        "type_id INTEGER REFERENCES event_types(id),"
+        "code INTEGER,"
+        "qual INTEGER,"
+        "msg_type INTEGER,"
+        "grp INTEGER,"
+        "zone INTEGER,"
+        "raw BLOB,"
+        "replicated INTEGER"
+        ");"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS replication_log ("
+        "seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "ts INTEGER,"
+        "kind TEXT,"
+        "event TEXT,"
+        "origin TEXT,"
+        "event_id INTEGER"
+        ");"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS replication_meta ("
+        "key TEXT PRIMARY KEY,"
+        "value TEXT"
+        ");"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS replication_peers ("
+        "peer_id TEXT PRIMARY KEY,"
+        "seq INTEGER"
+        ");"
+    )
+
+
+def meta_get(cur, key, default=None):
+    row = cur.execute("SELECT value FROM replication_meta WHERE key = ?;", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def meta_set(cur, key, value):
+    cur.execute(
+        "INSERT OR REPLACE INTO replication_meta (key, value) VALUES (?, ?);",
+        (key, None if value is None else str(value)),
+    )
+
+
+def _lookup_id(cur, table, name):
+    if name is None:
+        return None
+    ids = LOOKUP_IDS[table]
+    if name not in ids:
+        cur.execute(f"INSERT OR IGNORE INTO {table} (name) VALUES (?);", (name,))
+        cur.execute(f"SELECT id FROM {table} WHERE name = ?;", (name,))
+        ids[name] = cur.fetchone()[0]
+    return ids[name]
+
+
+def _encode_num(value):
+    # codes and message types are digit strings; anything odd is kept as text
+    if value is not None and value.isascii() and value.isdigit():
+        return int(value)
+    return value
+
+
+def _encode_qual(value):
+    if value is not None and len(value) == 1:
+        return ord(value)
+    return value
+
+
+def _encode_raw(raw, keep=False):
+    # without the capture journal the archive is the only copy of the frame
+    if raw is None or not (ARCHIVE_RAW or keep or not CAPTURE_ENABLED):
+        return None
+    return zlib.compress(raw.encode("utf-8"), 9)
+
+
+def _encode_row(cur, ts_ms, raw, event, keep_raw=False):
+    return (
+        ts_ms,
+        _lookup_id(cur, "accounts", event.get("account")),
+        _lookup_id(cur, "event_types", event.get("type")),
+        _encode_num(event.get("code")),
+        _encode_qual(event.get("qualifier")),
+        _encode_num(event.get("msg_type")),
+        event.get("group"),
+        event.get("zone"),
+        _encode_raw(raw, keep_raw),
+    )
+
+
+def _table_exists(cur, name):
+    return cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (name,)
+    ).fetchone() is not None
+
+
+def _migrate_legacy(cur):
+    # runs inside the caller's transaction
+    cur.execute("ALTER TABLE events RENAME TO events_legacy;")
+    _create_schema(cur)
+    cur.execute(
+        "SELECT id, ts, raw, account, type, code, qual, msg_type, grp, zone "
+        "FROM events_legacy ORDER BY id;"
+    )
+    rows = []
+    for r in cur.fetchall():
+        try:
+            ts_ms = int(datetime.fromisoformat(r[1]).replace(tzinfo=timezone.utc).timestamp() * 1000)
+        except (TypeError, ValueError):
+            ts_ms = None
+        event = {
+            "account": r[3],
+            "type": r[4],
+            "code": r[5],
+            "qualifier": r[6],
+            "msg_type": r[7],
+            "group": r[8],
+            "zone": r[9],
+        }
+        # legacy frames predate the capture journal, so raw is always kept
+        rows.append((r[0],) + _encode_row(cur, ts_ms, r[2], event, keep_raw=True))
+    cur.executemany(
+        "INSERT INTO events (id, ts, account_id, type_id, code, qual, msg_type, grp, zone, raw) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+        rows,
+    )
+    cur.execute("DROP TABLE events_legacy;")
+    print(f"[IPRO12] SQLite archive migrated to schema v{SCHEMA_VERSION} ({len(rows)} events)")
+
+
+def build_codes_response():
+    codes = []
+    for c, info in sorted(EVENT_CODES.items()):
+        codes.append({"code": c, "description": get_description(c)})
+    data = json.dumps(codes, ensure_ascii=False, indent=2).encode("utf-8")
+    etag = '"codes-' + hashlib.sha1(data).hexdigest()[:16] + '"'
+    return data, gzip.compress(data, 9), etag
+
+
+# the code table only depends on LANG, so it is served from memory
+CODES_JSON, CODES_GZIP, CODES_ETAG = build_codes_response()
+CODES_CACHE_CONTROL = "public, max-age=86400"
+
+# rendered "/" page, rebuilt only when DATA_VERSION moves
+PAGE_CACHE = {"version": None, "body": None}
+
+
 def init_db():
-    global DB_CONN
+    global DB_CONN, DATA_EXTERNAL, DATA_MODIFIED, REPL_SEQ, REPL_APPLIED, REPL_PRIMARY_ID, INSTANCE_ID
+    global REPL_UPLINK_FLOOR
     if not ARCHIVE_ENABLED:
         return None
     try:
         conn = sqlite3.connect(DB_PATH, check_same_thread=False)
         cur = conn.cursor()
-        cur.execute(
-            "CREATE TABLE IF NOT EXISTS events ("
-            "id INTEGER PRIMARY KEY AUTOINCREMENT,"
-            "ts TEXT,"
-            "raw TEXT,"
-            "account TEXT,"
-            "type TEXT,"
-            "code TEXT,"
-            "qual TEXT,"
-            "msg_type TEXT,"
-            "grp INTEGER,"
-            "zone INTEGER"
-            ");"
-        )
+        version = cur.execute("PRAGMA user_version;").fetchone()[0]
+        migrated = False
+        if version < SCHEMA_VERSION:
+            # sqlite3 would autocommit the DDL; run the upgrade as one
+            # explicit transaction so an interrupted migration rolls back
+            conn.isolation_level = None
+            cur.execute("BEGIN;")
+            try:
+                if version == 0 and _table_exists(cur, "events"):
+                    _migrate_legacy(cur)
+                    migrated = True
+                _create_schema(cur)
+                cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+                cur.execute("COMMIT;")
+            except Exception:
+                cur.execute("ROLLBACK;")
+                for table in LOOKUP_IDS:
+                    LOOKUP_IDS[table] = {}
+                raise
+            if migrated:
+                cur.execute("VACUUM;")
+            conn.isolation_level = ""
+        for table in LOOKUP_IDS:
+            LOOKUP_IDS[table] = dict(cur.execute(f"SELECT name, id FROM {table};").fetchall())
+        newest = cur.execute("SELECT MAX(ts) FROM events;").fetchone()[0]
+        if newest is not None:
+            DATA_MODIFIED = newest / 1000.0
+        DATA_EXTERNAL = cur.execute("PRAGMA data_version;").fetchone()[0]
+        REPL_SEQ = cur.execute("SELECT MAX(seq) FROM replication_log;").fetchone()[0] or 0
+        REPL_APPLIED = int(meta_get(cur, "primary_seq", 0))
+        REPL_PRIMARY_ID = meta_get(cur, "primary_id")
+        INSTANCE_ID = meta_get(cur, "instance_id")
+        if INSTANCE_ID is None:
+            # a rebuilt database is a new instance, so standbys resync
+            INSTANCE_ID = uuid.uuid4().hex
+            meta_set(cur, "instance_id", INSTANCE_ID)
+        if meta_get(cur, "role") == "primary" and REPLICATION_ROLE == "standby":
+            meta_set(cur, "uplink_floor", REPL_SEQ)
+        meta_set(cur, "role", REPLICATION_ROLE)
+        REPL_UPLINK_FLOOR = int(meta_get(cur, "uplink_floor", 0))
         conn.commit()
         DB_CONN = conn
         return conn
@@ -292,29 +556,112 @@ def init_db():
         return None
 
 
-def save_event_to_db(event):
-    if not ARCHIVE_ENABLED or DB_CONN is None:
+def _insert_event(cur, ts_ms, event, replicated=False, keep_raw=False):
+    cur.execute(
+        "INSERT INTO events (ts, account_id, type_id, code, qual, msg_type, grp, zone, raw, replicated) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+        _encode_row(cur, ts_ms, event.get("raw"), event, keep_raw) + (1 if replicated else None,),
+    )
+    return cur.lastrowid
+
+
+def db_rollback():
+    # called with DB_LOCK held after a failed write, so the half-done
+    # transaction is not committed with the next event
+    DB_CONN.rollback()
+    for table in LOOKUP_IDS:
+        # ids cached inside the rolled back transaction no longer exist
+        LOOKUP_IDS[table] = dict(DB_CONN.execute(f"SELECT name, id FROM {table};").fetchall())
+
+
+def data_changed():
+    # called after a commit that changed events
+    global DATA_VERSION, DATA_MODIFIED
+    DATA_VERSION += 1
+    DATA_MODIFIED = time.time()
+
+
+def data_sync():
+    # pick up commits made by another process on the same database
+    global DATA_EXTERNAL
+    if DB_CONN is None:
         return
     try:
-        cur = DB_CONN.cursor()
-        cur.execute(
-            "INSERT INTO events (ts, raw, account, type, code, qual, msg_type, grp, zone) "
-            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
-            (
-                datetime.utcnow().isoformat(timespec="seconds"),
-                event.get("raw"),
-                event.get("account"),
-                event.get("type"),
-                event.get("code"),
-                event.get("qualifier"),
-                event.get("msg_type"),
-                event.get("group"),
-                event.get("zone"),
-            ),
-        )
-        DB_CONN.commit()
+        with DB_LOCK:
+            version = DB_CONN.execute("PRAGMA data_version;").fetchone()[0]
+            if version != DATA_EXTERNAL:
+                DATA_EXTERNAL = version
+                data_changed()
+    except Exception as e:
+        print("[IPRO12] SQLite data_version error:", e)
+
+
+def save_event_to_db(event, kind="event", ts_ms=None):
+    """Archive an event and append it to the replication log.
+
+    kind is "event" for dispatched events and "archive" for quarantined
+    ones, so standbys know whether to apply it to their state registry.
+    ts_ms defaults to now; replay passes the recorded arrival time.
+    On a primary the log is streamed to standbys; on a standby it holds
+    frames received directly, to be sent up to the primary. Returns the
+    primary log seq, for the caller to wait on before ACKing the panel.
+    """
+    if not ARCHIVE_ENABLED or DB_CONN is None:
+        return None
+    seq = None
+    try:
+        if ts_ms is None:
+            ts_ms = int(time.time() * 1000)
+        with DB_LOCK:
+            cur = DB_CONN.cursor()
+            try:
+                event_id = _insert_event(cur, ts_ms, event)
+                if REPLICATION_ROLE in ("primary", "standby"):
+                    seq = repl_log_append(cur, ts_ms, kind, event, INSTANCE_ID, event_id)
+                DB_CONN.commit()
+            except Exception:
+                db_rollback()
+                raise
+            data_changed()
     except Exception as e:
         print("[IPRO12] SQLite insert error:", e)
+        return None
+    if seq is not None and REPLICATION_ROLE == "primary":
+        repl_notify(seq)
+        return seq
+    return None
+
+
+def _decode_code(value):
+    return f"{value:03d}" if isinstance(value, int) else value
+
+
+def _decode_qual(value):
+    return chr(value) if isinstance(value, int) else value
+
+
+def _event_from_row(r):
+    # r = (raw, account, type, code, qual, msg_type, grp, zone)
+    code = _decode_code(r[3])
+    return {
+        "raw": zlib.decompress(r[0]).decode("utf-8") if r[0] is not None else None,
+        "account": r[1],
+        "type": r[2],
+        "code": code,
+        "qualifier": _decode_qual(r[4]),
+        "msg_type": str(r[5]) if r[5] is not None else None,
+        "group": r[6],
+        "zone": r[7],
+        "description": get_description(code),
+    }
+
+
+EVENT_COLUMNS = (
+    "e.raw, a.name, t.name, e.code, e.qual, e.msg_type, e.grp, e.zone "
+    "FROM events e "
+    "LEFT JOIN accounts a ON a.id = e.account_id "
+    "LEFT JOIN event_types t ON t.id = e.type_id"
+)
 
 
 def query_events(limit=100, zone=None, etype=None):
@@ -322,44 +669,391 @@ def query_events(limit=100, zone=None, etype=None):
         return []
     try:
         cur = DB_CONN.cursor()
-        sql = "SELECT ts, raw, account, type, code, qual, msg_type, grp, zone FROM events"
+        sql = "SELECT e.ts, " + EVENT_COLUMNS
         params = []
         cond = []
         if zone is not None:
-            cond.append("zone = ?")
+            cond.append("e.zone = ?")
             params.append(zone)
         if etype is not None:
-            cond.append("type = ?")
+            cond.append("e.type_id = (SELECT id FROM event_types WHERE name = ?)")
             params.append(etype)
         if cond:
             sql += " WHERE " + " AND ".join(cond)
-        sql += " ORDER BY id DESC LIMIT ?"
+        sql += " ORDER BY e.id DESC LIMIT ?"
         params.append(limit)
-        cur.execute(sql, params)
-        rows = cur.fetchall()
+        with DB_LOCK:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
         res = []
         for r in rows:
-            code = r[4]
-            res.append(
-                {
-                    "ts": r[0],
-                    "raw": r[1],
-                    "account": r[2],
-                    "type": r[3],
-                    "code": code,
-                    "qualifier": r[5],
-                    "msg_type": r[6],
-                    "group": r[7],
-                    "zone": r[8],
-                    "description": get_description(code),
-                }
-            )
+            ts = None
+            if r[0] is not None:
+                ts = datetime.utcfromtimestamp(r[0] / 1000.0).isoformat(timespec="seconds")
+            res.append(dict({"ts": ts}, **_event_from_row(r[1:])))
         return res
     except Exception as e:
         print("[IPRO12] SQLite query error:", e)
         return []
 
 
+# Capture journal: append-only binary file of every received frame.
+# File layout: CAPTURE_MAGIC, then records of
+#   header (crc32 of body, ts_ms, ack byte, peer_len, raw_len, parsed_len)
+#   body   (peer utf-8, raw bytes, parsed event as JSON utf-8 or empty)
+# ack byte: 0x06 ACK, 0x15 NAK, 0x00 nothing sent.
+CAPTURE_MAGIC = b"IPROCAP1"
+CAPTURE_REC = struct.Struct("<IqBHII")
+ACK = b"\x06"
+NAK = b"\x15"
+
+
+def capture_scan(buf):
+    """Walk the records in a journal buffer.
+
+    Returns (timestamps, offsets, end) where end is the offset just past
+    the last complete record. Checksums are left to the reader, which
+    skips bad records without losing the ones after them.
+    """
+    index_ts = []
+    index_off = []
+    if buf[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+        return index_ts, index_off, 0
+    pos = len(CAPTURE_MAGIC)
+    end = len(buf)
+    while pos + CAPTURE_REC.size <= end:
+        _, ts_ms, _, peer_len, raw_len, parsed_len = CAPTURE_REC.unpack_from(buf, pos)
+        body_at = pos + CAPTURE_REC.size
+        nxt = body_at + peer_len + raw_len + parsed_len
+        if nxt > end:
+            # torn record at the tail (crash or still being written)
+            break
+        index_ts.append(ts_ms)
+        index_off.append(pos)
+        pos = nxt
+    return index_ts, index_off, pos
+
+
+def capture_files(path=CAPTURE_PATH):
+    """Existing journal files for path, oldest rotation first."""
+    files = []
+    for i in range(CAPTURE_BACKUPS, 0, -1):
+        name = f"{path}.{i}"
+        if os.path.exists(name):
+            files.append(name)
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+class CaptureJournal:
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.f = None
+        self.size = 0
+        self._open()
+
+    def _repair(self):
+        # drop a partial record left by a crash so new records stay reachable;
+        # complete records with a bad checksum are kept, the reader skips them
+        with open(self.path, "r+b") as f:
+            buf = f.read()
+            _, _, end = capture_scan(buf)
+            if end == 0:
+                print(f"[IPRO12] Capture: {self.path} is not a journal, moved to {self.path}.bad")
+                f.close()
+                os.replace(self.path, f"{self.path}.bad")
+            elif end < len(buf):
+                print(f"[IPRO12] Capture: truncating {len(buf) - end} bytes of torn tail in {self.path}")
+                f.truncate(end)
+
+    def _open(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            self._repair()
+        self.f = open(self.path, "ab", buffering=CAPTURE_BUFFER_SIZE)
+        self.size = self.f.tell()
+        if self.size == 0:
+            self.f.write(CAPTURE_MAGIC)
+            self.size = len(CAPTURE_MAGIC)
+
+    def _rotate(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def append(self, ts_ms, peer, raw, parsed, ack):
+        peer_b = str(peer).encode("utf-8")
+        parsed_b = b""
+        if parsed is not None:
+            parsed_b = json.dumps(parsed, ensure_ascii=False).encode("utf-8")
+        body = peer_b + raw + parsed_b
+        header = CAPTURE_REC.pack(
+            zlib.crc32(body),
+            ts_ms,
+            ack[0] if ack else 0,
+            len(peer_b),
+            len(raw),
+            len(parsed_b),
+        )
+        with self.lock:
+            rec_len = len(header) + len(body)
+            if self.size + rec_len > self.max_bytes and self.size > len(CAPTURE_MAGIC):
+                self._rotate()
+            self.f.write(header + body)
+            self.size += rec_len
+
+    def flush(self):
+        with self.lock:
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.f.closed:
+                self.f.close()
+
+
+class CaptureReader:
+    """Memory-mapped reader for a single journal file.
+
+    The time index is built from record headers on open; records are
+    appended in arrival order, so it is sorted and can be bisected.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_ts = []
+        self.index_off = []
+        self._f = open(path, "rb")
+        self._mm = None
+        if os.fstat(self._f.fileno()).st_size > 0:
+            self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._build_index()
+
+    def _build_index(self):
+        if self._mm is not None:
+            self.index_ts, self.index_off, _ = capture_scan(self._mm)
+
+    def _record_at(self, off):
+        crc, ts_ms, ack, peer_len, raw_len, parsed_len = CAPTURE_REC.unpack_from(self._mm, off)
+        pos = off + CAPTURE_REC.size
+        body = self._mm[pos:pos + peer_len + raw_len + parsed_len]
+        if zlib.crc32(body) != crc:
+            print(f"[IPRO12] Capture: bad checksum at {self.path}:{off}, skipped")
+            return None
+        parsed_b = body[peer_len + raw_len:]
+        return {
+            "ts_ms": ts_ms,
+            "peer": body[:peer_len].decode("utf-8", errors="replace"),
+            "raw": body[peer_len:peer_len + raw_len],
+            "parsed": json.loads(parsed_b.decode("utf-8")) if parsed_b else None,
+            "ack": bytes([ack]) if ack else None,
+        }
+
+    def __len__(self):
+        return len(self.index_off)
+
+    def records(self, start_ms=None, end_ms=None):
+        i = 0
+        if start_ms is not None:
+            i = bisect.bisect_left(self.index_ts, start_ms)
+        for j in range(i, len(self.index_off)):
+            if end_ms is not None and self.index_ts[j] > end_ms:
+                break
+            rec = self._record_at(self.index_off[j])
+            if rec is not None:
+                yield rec
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def init_capture():
+    global CAPTURE
+    if not CAPTURE_ENABLED:
+        return None
+    try:
+        CAPTURE = CaptureJournal(CAPTURE_PATH, CAPTURE_MAX_BYTES, CAPTURE_BACKUPS)
+        return CAPTURE
+    except Exception as e:
+        print("[IPRO12] Capture journal init error:", e)
+        CAPTURE = None
+        return None
+
+
+def capture_frame(peer, raw, parsed, ack):
+    if CAPTURE is None:
+        return
+    try:
+        CAPTURE.append(int(time.time() * 1000), peer, raw, parsed, ack)
+    except Exception as e:
+        print("[IPRO12] Capture write error:", e)
+
+
+def close_capture():
+    if CAPTURE is None:
+        return
+    try:
+        CAPTURE.close()
+    except Exception as e:
+        print("[IPRO12] Capture close error:", e)
+
+
+def handle_sigterm(signum, frame):
+    # the Supervisor stops add-ons with SIGTERM; exit through atexit so
+    # buffered journal records reach the disk
+    raise SystemExit(0)
+
+
+def capture_flush_loop():
+    while True:
+        time.sleep(CAPTURE_FLUSH_INTERVAL)
+        if CAPTURE is None:
+            continue
+        try:
+            CAPTURE.flush()
+        except Exception as e:
+            print("[IPRO12] Capture flush error:", e)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.ts = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class RateLimiter:
+    """Token bucket per key (source IP or account). rate_per_min <= 0 disables it."""
+
+    MAX_KEYS = 1024
+
+    def __init__(self, rate_per_min, burst):
+        self.rate = rate_per_min / 60.0
+        self.burst = max(1, burst)
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def allow(self, key):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.MAX_KEYS:
+                    self._prune(now)
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+            return bucket.take(now)
+
+    def _prune(self, now):
+        # buckets that have refilled completely carry no state worth keeping
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+
+
+IP_LIMITER = RateLimiter(RATE_IP_PER_MIN, RATE_IP_BURST)
+ACCOUNT_LIMITER = RateLimiter(RATE_ACCOUNT_PER_MIN, RATE_ACCOUNT_BURST)
+# open connections per source IP, bounded overall and per source
+CONN_LOCK = threading.Lock()
+CONN_ACTIVE = {}
+
+# never quarantined: HA must see alarms, restores, arming and power state
+# even when a panel flushes a backlog after a comms restore
+PRIORITY_TYPES = (
+    "alarm", "alarm_restore", "arm_event", "arm_restore",
+    "power_lost", "power_restore", "battery_low",
+)
+
+
+def conn_admit(ip):
+    with CONN_LOCK:
+        if sum(CONN_ACTIVE.values()) >= MAX_CONNECTIONS:
+            return False
+        if CONN_ACTIVE.get(ip, 0) >= MAX_CONNECTIONS_PER_IP:
+            return False
+        CONN_ACTIVE[ip] = CONN_ACTIVE.get(ip, 0) + 1
+        return True
+
+
+def conn_release(ip):
+    with CONN_LOCK:
+        CONN_ACTIVE[ip] -= 1
+        if CONN_ACTIVE[ip] <= 0:
+            del CONN_ACTIVE[ip]
+
+
+METRICS_LOCK = threading.Lock()
+METRICS = {
+    "connections_accepted": 0,
+    "connections_rejected": 0,
+    "connections_timed_out": 0,
+    "frames_received": 0,
+    "frames_quarantined": 0,
+    "frames_dropped": 0,
+    "replication_auth_failures": 0,
+    "rejected_sources": {},
+    "quarantined_sources": {},
+    "quarantined_accounts": {},
+}
+# per-source counters are bounded like the rate limiter buckets
+METRICS_MAX_KEYS = 1024
+
+
+def metric_inc(name, key=None):
+    with METRICS_LOCK:
+        if key is None:
+            METRICS[name] += 1
+        else:
+            counts = METRICS[name]
+            if key not in counts and len(counts) >= METRICS_MAX_KEYS:
+                # forget the quietest source to make room
+                del counts[min(counts, key=counts.get)]
+            counts[key] = counts.get(key, 0) + 1
+
+
+def metrics_snapshot():
+    with METRICS_LOCK:
+        snap = {k: (dict(v) if isinstance(v, dict) else v) for k, v in METRICS.items()}
+    snap["max_connections"] = MAX_CONNECTIONS
+    snap["max_connections_per_ip"] = MAX_CONNECTIONS_PER_IP
+    with CONN_LOCK:
+        snap["active_connections"] = dict(CONN_ACTIVE)
+    snap["replication"] = replication_status()
+    return snap
+
+
 def mqtt_publish(topic_suffix, payload, retain=False):
     if not USE_MQTT:
         return
@@ -624,26 +1318,102 @@ def supervision_watchdog():
                     mqtt_publish("status/connection", CONNECTION_STATE, retain=True)
 
 
+def data_etag():
+    data_sync()
+    return f'"{BOOT_ID}-{DATA_VERSION}"'
+
+
+def render_index_page():
+    events = query_events(limit=100)
+    rows = ["<tr><th>Время</th><th>Тип</th><th>Код</th><th>Описание</th><th>Зона</th><th>Группа</th><th>Raw</th></tr>"]
+    for e in events:
+        rows.append(
+            "<tr>"
+            f"<td>{e['ts']}</td>"
+            f"<td>{e['type']}</td>"
+            f"<td>{e['code']}</td>"
+            f"<td>{e.get('description','')}</td>"
+            f"<td>{e['zone']}</td>"
+            f"<td>{e['group']}</td>"
+            f"<td>{e['raw'] or ''}</td>"
+            "</tr>"
+        )
+    table = "<table border='1' cellspacing='0' cellpadding='4'>" + "".join(rows) + "</table>"
+    html = (
+        "<!DOCTYPE html><html><head><meta charset='utf-8'>"
+        "<title>IPRO12 Surgard History</title></head><body>"
+        "<h1>IPRO12 Surgard Receiver</h1>"
+        "<p>Последние события (макс 100):</p>"
+        + table +
+        "</body></html>"
+    )
+    return html.encode("utf-8")
+
+
 class SimpleHandler(BaseHTTPRequestHandler):
-    def _send_json(self, obj, status=200):
-        data = json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
-        self.send_header("Content-Length", str(len(data)))
+    def _etag_matches(self, etag):
+        header = self.headers.get("If-None-Match")
+        if not header:
+            return False
+        tags = [t.strip() for t in header.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+    def _send_not_modified(self, etag, cache_control=None, last_modified=None):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        if cache_control:
+            self.send_header("Cache-Control", cache_control)
+        if last_modified is not None:
+            self.send_header("Last-Modified", formatdate(last_modified, usegmt=True))
         self.end_headers()
-        self.wfile.write(data)
 
-    def _send_html(self, html, status=200):
-        data = html.encode("utf-8")
+    def _send_bytes(self, data, content_type, status=200, etag=None,
+                    cache_control=None, last_modified=None, gzip_data=None):
+        if etag is not None and status == 200 and self._etag_matches(etag):
+            return self._send_not_modified(etag, cache_control, last_modified)
+        encoding = None
+        if gzip_data is not None and "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip_data
+            encoding = "gzip"
         self.send_response(status)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Type", content_type)
         self.send_header("Content-Length", str(len(data)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        if gzip_data is not None:
+            self.send_header("Vary", "Accept-Encoding")
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if cache_control:
+            self.send_header("Cache-Control", cache_control)
+        if last_modified is not None:
+            self.send_header("Last-Modified", formatdate(last_modified, usegmt=True))
         self.end_headers()
         self.wfile.write(data)
 
+    def _send_json(self, obj, status=200, **cache):
+        data = json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+        self._send_bytes(data, "application/json; charset=utf-8", status, **cache)
+
+    def _send_html(self, html, status=200, **cache):
+        data = html.encode("utf-8") if isinstance(html, str) else html
+        self._send_bytes(data, "text/html; charset=utf-8", status, **cache)
+
+    def _data_cache(self):
+        # revalidate on every poll; a 304 costs no SQLite query
+        return {
+            "etag": data_etag(),
+            "cache_control": "no-cache",
+            "last_modified": DATA_MODIFIED,
+        }
+
     def do_GET(self):
         parsed = urlparse(self.path)
         if parsed.path == "/history":
+            cache = self._data_cache()
+            if self._etag_matches(cache["etag"]):
+                return self._send_not_modified(**cache)
+
             qs = parse_qs(parsed.query)
             limit = int(qs.get("limit", ["100"])[0])
             zone = qs.get("zone", [None])[0]
@@ -657,43 +1427,55 @@ class SimpleHandler(BaseHTTPRequestHandler):
                     zint = None
 
             events = query_events(limit=limit, zone=zint, etype=etype)
-            return self._send_json(events)
+            return self._send_json(events, **cache)
+
+        if parsed.path == "/metrics":
+            return self._send_json(metrics_snapshot())
 
         if parsed.path == "/codes":
-            codes = []
-            for c, info in sorted(EVENT_CODES.items()):
-                codes.append({"code": c, "description": get_description(c)})
-            return self._send_json(codes)
+            return self._send_bytes(
+                CODES_JSON,
+                "application/json; charset=utf-8",
+                etag=CODES_ETAG,
+                cache_control=CODES_CACHE_CONTROL,
+                gzip_data=CODES_GZIP,
+            )
 
         if parsed.path == "/":
-            events = query_events(limit=100)
-            rows = ["<tr><th>Время</th><th>Тип</th><th>Код</th><th>Описание</th><th>Зона</th><th>Группа</th><th>Raw</th></tr>"]
-            for e in events:
-                rows.append(
-                    "<tr>"
-                    f"<td>{e['ts']}</td>"
-                    f"<td>{e['type']}</td>"
-                    f"<td>{e['code']}</td>"
-                    f"<td>{e.get('description','')}</td>"
-                    f"<td>{e['zone']}</td>"
-                    f"<td>{e['group']}</td>"
-                    f"<td>{e['raw']}</td>"
-                    "</tr>"
-                )
-            table = "<table border='1' cellspacing='0' cellpadding='4'>" + "".join(rows) + "</table>"
-            html = (
-                "<!DOCTYPE html><html><head><meta charset='utf-8'>"
-                "<title>IPRO12 Surgard History</title></head><body>"
-                "<h1>IPRO12 Surgard Receiver</h1>"
-                "<p>Последние события (макс 100):</p>"
-                + table +
-                "</body></html>"
-            )
-            return self._send_html(html)
+            cache = self._data_cache()
+            if self._etag_matches(cache["etag"]):
+                return self._send_not_modified(**cache)
+            version = DATA_VERSION
+            if PAGE_CACHE["version"] != version:
+                PAGE_CACHE["body"] = render_index_page()
+                PAGE_CACHE["version"] = version
+            return self._send_html(PAGE_CACHE["body"], **cache)
 
         self.send_error(404, "Not Found")
 
 
+def dispatch_event(event, ts_ms=None):
+    seq = save_event_to_db(event, ts_ms=ts_ms)
+    update_states_from_event(event)
+    mqtt_publish("event", json.dumps(event, ensure_ascii=False), retain=False)
+    mqtt_publish(f"zone/{event['zone']}", event["type"], retain=False)
+    mqtt_publish(
+        "status/last_event",
+        f"{event['type']} code {event['code']} zone {event['zone']}",
+        retain=True,
+    )
+    publish_status()
+    send_webhook(event)
+    return seq
+
+
+def quarantine_event(event, metric, key):
+    # over the rate limit: keep it in the archive, skip state, MQTT and webhook
+    metric_inc("frames_quarantined")
+    metric_inc(metric, key)
+    return save_event_to_db(event, kind="archive")
+
+
 def start_http_server():
     server = HTTPServer(("0.0.0.0", HTTP_PORT), SimpleHandler)
     print(f"[IPRO12] HTTP server started on port {HTTP_PORT}")
@@ -702,13 +1484,18 @@ def start_http_server():
 
 def start_surgard_server():
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s.bind(("0.0.0.0", SURGARD_PORT))
-    s.listen(5)
+    s.listen(max(5, MAX_CONNECTIONS))
 
     print(f"[IPRO12] Surgard Receiver started on port {SURGARD_PORT}")
     print(f"[IPRO12] MQTT enabled: {USE_MQTT}, host: {MQTT_HOST}:{MQTT_PORT}, base: {MQTT_BASE_TOPIC}")
     print(f"[IPRO12] Webhook enabled: {WEBHOOK_ENABLED}, url: {WEBHOOK_URL}")
     print(f"[IPRO12] Archive enabled: {ARCHIVE_ENABLED}, db: {DB_PATH}")
+    print(f"[IPRO12] Capture enabled: {CAPTURE_ENABLED}, journal: {CAPTURE_PATH}")
+    print(f"[IPRO12] Max connections: {MAX_CONNECTIONS} ({MAX_CONNECTIONS_PER_IP} per IP), timeout: {CONN_TIMEOUT} sec")
+    print(f"[IPRO12] Rate limits per min: ip {RATE_IP_PER_MIN}/{RATE_IP_BURST}, account {RATE_ACCOUNT_PER_MIN}/{RATE_ACCOUNT_BURST}")
+    print(f"[IPRO12] Replication role: {REPLICATION_ROLE}")
     print(f"[IPRO12] Supervision timeout: {SUPERVISION_TIMEOUT} sec")
     print(f"[IPRO12] Language: {LANG}")
 
@@ -717,41 +1504,618 @@ def start_surgard_server():
 
     while True:
         conn, addr = s.accept()
-        try:
-            data = conn.recv(1024).decode(errors="ignore")
-            if not data:
-                conn.close()
-                continue
+        if not conn_admit(addr[0]):
+            metric_inc("connections_rejected")
+            metric_inc("rejected_sources", addr[0])
+            conn.close()
+            continue
+        metric_inc("connections_accepted")
+        t = threading.Thread(target=handle_connection, args=(conn, addr), daemon=True)
+        t.start()
+
 
+def handle_connection(conn, addr):
+    try:
+        conn.settimeout(CONN_TIMEOUT)
+        raw = conn.recv(1024)
+        if not raw:
+            return
+        metric_inc("frames_received")
+
+        # checked before parsing so junk from a looping source is limited too
+        ip_ok = IP_LIMITER.allow(addr[0])
+        data = raw.decode(errors="ignore")
+        if CAPTURE is None:
             print(f"[IPRO12] RAW from {addr}: {repr(data)}")
-            event = parse_contact_id(data)
-            if event:
+        event = parse_contact_id(data)
+        priority = event is not None and event["type"] in PRIORITY_TYPES
+        seq = None
+        if event:
+            if CAPTURE is None:
                 print("[IPRO12] Parsed event:", event)
-                save_event_to_db(event)
-                update_states_from_event(event)
-                mqtt_publish("event", json.dumps(event, ensure_ascii=False), retain=False)
-                mqtt_publish(f"zone/{event['zone']}", event["type"], retain=False)
-                mqtt_publish(
-                    "status/last_event",
-                    f"{event['type']} code {event['code']} zone {event['zone']}",
-                    retain=True,
+            if priority:
+                seq = dispatch_event(event)
+            elif not ip_ok:
+                seq = quarantine_event(event, "quarantined_sources", addr[0])
+            elif not ACCOUNT_LIMITER.allow(event["account"]):
+                seq = quarantine_event(event, "quarantined_accounts", event["account"])
+            else:
+                seq = dispatch_event(event)
+        if seq is not None:
+            # only the panel ACK waits for the standby, never HA dispatch
+            repl_wait(seq)
+
+        ack = ACK
+        try:
+            conn.sendall(ack)
+        except Exception:
+            ack = None
+        if event is None and not ip_ok:
+            # over the limit and unparseable: keep it out of the journal
+            # so it cannot rotate real records away
+            metric_inc("frames_dropped")
+        else:
+            capture_frame(f"{addr[0]}:{addr[1]}", raw, event, ack)
+
+    except socket.timeout:
+        metric_inc("connections_timed_out")
+    except Exception as e:
+        print("[IPRO12] Error handling connection:", e)
+    finally:
+        conn.close()
+        conn_release(addr[0])
+
+
+# Replication: every instance logs the events it archives itself in
+# replication_log. A primary streams its log to standbys over TCP as JSON
+# lines; a standby sends frames it received directly (primary down, panel
+# on the backup channel) up to the primary.
+#   primary -> standby  {"op": "challenge", "nonce": ...}
+#   standby -> primary  {"op": "hello", "id": ..., "primary_id": ..., "from_seq": N, "nonce": ..., "auth": ...}
+#   primary -> standby  {"op": "welcome", "primary_id": ..., "uplink_seq": N, "auth": ...}
+#   standby -> primary  {"op": "uplink", "seq": N, "ts_ms": ..., "kind": ..., "event": {...}} ...
+#                       {"op": "ready", "uplinked": N}
+#   primary -> standby  {"op": "snapshot_begin", "seq": N}, {"op": "snapshot_row", ...} ...,
+#                       {"op": "snapshot_end", "seq": N}  (only when resyncing)
+#                       {"op": "entry", "seq": N, "ts_ms": ..., "kind": ..., "origin": ..., "event": {...}}
+#                       {"op": "ping", "seq": N}
+#   standby -> primary  {"op": "ack", "seq": N}, later {"op": "uplink", ...}
+# Both sides prove knowledge of replication_secret with an HMAC over both
+# nonces; every later line carries a MAC under a session key (ReplLink).
+# The stream is not encrypted. A standby gets a full snapshot of the
+# primary's archive when it is new, when the primary id changed (rebuilt
+# database, role swap) or when the log no longer reaches back to its
+# position; otherwise it resumes.
+def repl_log_append(cur, ts_ms, kind, event, origin, event_id):
+    # called with DB_LOCK held, inside the archive transaction
+    cur.execute(
+        "INSERT INTO replication_log (ts, kind, event, origin, event_id) VALUES (?, ?, ?, ?, ?);",
+        (ts_ms, kind, json.dumps(event, ensure_ascii=False), origin, event_id),
+    )
+    seq = cur.lastrowid
+    if seq % 1000 == 0:
+        cur.execute("DELETE FROM replication_log WHERE seq <= ?;", (seq - REPLICATION_LOG_KEEP,))
+    return seq
+
+
+def repl_log_read(after_seq, limit=500):
+    if DB_CONN is None:
+        return []
+    with DB_LOCK:
+        rows = DB_CONN.execute(
+            "SELECT seq, ts, kind, event, origin FROM replication_log "
+            "WHERE seq > ? ORDER BY seq LIMIT ?;",
+            (after_seq, limit),
+        ).fetchall()
+    return [
+        {"op": "entry", "seq": r[0], "ts_ms": r[1], "kind": r[2], "origin": r[4], "event": json.loads(r[3])}
+        for r in rows
+    ]
+
+
+def repl_notify(seq):
+    global REPL_SEQ
+    with REPL_COND:
+        REPL_SEQ = max(REPL_SEQ, seq)
+        REPL_COND.notify_all()
+
+
+def repl_wait(seq):
+    """Hold the panel ACK until a caught-up standby has the event.
+
+    Standbys that are still catching up (or never ack) are not waited
+    on; one that misses the timeout drops out until it catches up again.
+    """
+    if REPLICATION_SYNC_TIMEOUT <= 0:
+        return
+    with REPL_COND:
+        waiting = [name for name, st in REPL_STANDBYS.items() if st["caught_up"]]
+        if not waiting:
+            return
+
+        def acked():
+            live = [REPL_STANDBYS[n] for n in waiting if n in REPL_STANDBYS]
+            return not live or any(st["acked"] >= seq for st in live)
+
+        if REPL_COND.wait_for(acked, REPLICATION_SYNC_TIMEOUT):
+            return
+        for name in waiting:
+            st = REPL_STANDBYS.get(name)
+            if st is not None and st["acked"] < seq:
+                st["caught_up"] = False
+    print(f"[IPRO12] Replication: no standby ack for seq {seq} within {REPLICATION_SYNC_TIMEOUT} sec")
+
+
+def _repl_mac(key, *parts):
+    msg = "|".join(str(p) for p in parts).encode("utf-8")
+    return hmac.new(key, msg, hashlib.sha256).hexdigest()
+
+
+def _repl_auth(nonce, peer_nonce, role, instance_id):
+    # proof of replication_secret bound to both sides' fresh nonces
+    return _repl_mac(REPLICATION_SECRET.encode("utf-8"), nonce, peer_nonce, role, instance_id)
+
+
+class ReplLink:
+    """JSON lines over a replication connection.
+
+    Handshake lines are sent bare. After secure(), every line is prefixed
+    with an HMAC over the direction, a per-direction counter and the line,
+    keyed by a session key derived from both nonces, so lines cannot be
+    forged, altered, replayed or reordered.
+    """
+
+    def __init__(self, conn, role, peer_role):
+        self.conn = conn
+        self.f = conn.makefile("rb")
+        self.role = role
+        self.peer_role = peer_role
+        self.key = None
+        self.sent = 0
+        self.received = 0
+
+    def secure(self, nonce, peer_nonce):
+        self.key = bytes.fromhex(
+            _repl_mac(REPLICATION_SECRET.encode("utf-8"), "session", nonce, peer_nonce)
+        )
+
+    def _encode(self, msg):
+        body = json.dumps(msg, ensure_ascii=False)
+        if self.key is not None:
+            body = _repl_mac(self.key, self.role, self.sent, body) + " " + body
+            self.sent += 1
+        return body.encode("utf-8") + b"\n"
+
+    def send(self, msg):
+        self.conn.sendall(self._encode(msg))
+
+    def send_many(self, msgs):
+        self.conn.sendall(b"".join(self._encode(m) for m in msgs))
+
+    def read(self):
+        line = self.f.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        body = line.decode("utf-8").rstrip("\n")
+        if self.key is not None:
+            mac, _, body = body.partition(" ")
+            if not hmac.compare_digest(mac, _repl_mac(self.key, self.peer_role, self.received, body)):
+                metric_inc("replication_auth_failures")
+                raise ConnectionError("bad line MAC")
+            self.received += 1
+        return json.loads(body)
+
+
+def start_replication_server():
+    if not REPLICATION_SECRET:
+        print("[IPRO12] Replication: replication_secret is not set, primary disabled")
+        return
+    if DB_CONN is None:
+        print("[IPRO12] Replication: archive is disabled, primary disabled")
+        return
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(("0.0.0.0", REPLICATION_PORT))
+    s.listen(5)
+    print(f"[IPRO12] Replication primary {INSTANCE_ID} listening on port {REPLICATION_PORT}")
+    while True:
+        conn, addr = s.accept()
+        t = threading.Thread(target=serve_standby, args=(conn, addr), daemon=True)
+        t.start()
+
+
+def apply_uplink(peer_id, msg):
+    # a frame the standby received directly; archived here and logged
+    # with the standby as origin so it is not echoed back to it
+    with DB_LOCK:
+        cur = DB_CONN.cursor()
+        row = cur.execute("SELECT seq FROM replication_peers WHERE peer_id = ?;", (peer_id,)).fetchone()
+        if row and msg["seq"] <= row[0]:
+            return
+        try:
+            event_id = _insert_event(cur, msg["ts_ms"], msg["event"], keep_raw=True)
+            seq = repl_log_append(cur, msg["ts_ms"], "archive", msg["event"], peer_id, event_id)
+            cur.execute(
+                "INSERT OR REPLACE INTO replication_peers (peer_id, seq) VALUES (?, ?);",
+                (peer_id, msg["seq"]),
+            )
+            DB_CONN.commit()
+        except Exception:
+            db_rollback()
+            raise
+        data_changed()
+    repl_notify(seq)
+
+
+def repl_snapshot():
+    with DB_LOCK:
+        cur = DB_CONN.cursor()
+        seq = cur.execute("SELECT MAX(seq) FROM replication_log;").fetchone()[0] or 0
+        rows = cur.execute("SELECT e.ts, " + EVENT_COLUMNS + " ORDER BY e.id;").fetchall()
+    return seq, rows
+
+
+def _read_acks(link, name, peer_id):
+    try:
+        while True:
+            msg = link.read()
+            op = msg.get("op")
+            if op == "ack":
+                with REPL_COND:
+                    st = REPL_STANDBYS.get(name)
+                    if st is not None:
+                        st["acked"] = max(st["acked"], int(msg["seq"]))
+                        if st["acked"] >= REPL_SEQ:
+                            st["caught_up"] = True
+                    REPL_COND.notify_all()
+            elif op == "uplink":
+                apply_uplink(peer_id, msg)
+    except Exception:
+        pass
+    finally:
+        # wake the sender so it notices the standby is gone
+        try:
+            link.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        with REPL_COND:
+            REPL_STANDBYS.pop(name, None)
+            REPL_COND.notify_all()
+
+
+def serve_standby(conn, addr):
+    name = f"{addr[0]}:{addr[1]}"
+    registered = False
+    try:
+        conn.settimeout(REPLICATION_PING_INTERVAL * 3)
+        link = ReplLink(conn, "primary", "standby")
+        nonce = uuid.uuid4().hex
+        link.send({"op": "challenge", "nonce": nonce})
+        hello = link.read()
+        peer_id = str(hello.get("id", ""))
+        peer_nonce = str(hello.get("nonce", ""))
+        auth = str(hello.get("auth", ""))
+        if hello.get("op") != "hello" or not peer_id or not peer_nonce or not hmac.compare_digest(
+            auth, _repl_auth(nonce, peer_nonce, "standby", peer_id)
+        ):
+            metric_inc("replication_auth_failures")
+            metric_inc("rejected_sources", addr[0])
+            print(f"[IPRO12] Replication: {name} failed authentication")
+            return
+        from_seq = int(hello.get("from_seq", 0))
+
+        with DB_LOCK:
+            row = DB_CONN.execute(
+                "SELECT seq FROM replication_peers WHERE peer_id = ?;", (peer_id,)
+            ).fetchone()
+        link.send({
+            "op": "welcome",
+            "primary_id": INSTANCE_ID,
+            "uplink_seq": row[0] if row else 0,
+            "auth": _repl_auth(nonce, peer_nonce, "primary", INSTANCE_ID),
+        })
+        link.secure(nonce, peer_nonce)
+
+        # take what the standby received on its own before the snapshot,
+        # so the snapshot already contains it
+        while True:
+            msg = link.read()
+            if msg.get("op") == "uplink":
+                apply_uplink(peer_id, msg)
+            elif msg.get("op") == "ready":
+                break
+
+        with REPL_COND:
+            REPL_STANDBYS[name] = {"id": peer_id, "acked": 0, "caught_up": False}
+        registered = True
+
+        with DB_LOCK:
+            head, oldest = DB_CONN.execute(
+                "SELECT MAX(seq), MIN(seq) FROM replication_log;"
+            ).fetchone()
+        head = head or 0
+        resync = (
+            hello.get("primary_id") != INSTANCE_ID
+            or from_seq > head
+            or (oldest is not None and from_seq < oldest - 1)
+        )
+        if resync:
+            sent, rows = repl_snapshot()
+            print(f"[IPRO12] Replication: standby {peer_id} at {name} resyncing, snapshot of {len(rows)} events at seq {sent}")
+            link.send({"op": "snapshot_begin", "seq": sent})
+            for i in range(0, len(rows), 500):
+                link.send_many(
+                    {"op": "snapshot_row", "ts_ms": r[0], "event": _event_from_row(r[1:])}
+                    for r in rows[i:i + 500]
                 )
-                publish_status()
-                send_webhook(event)
+            link.send({"op": "snapshot_end", "seq": sent})
+        else:
+            sent = from_seq
+            print(f"[IPRO12] Replication: standby {peer_id} at {name} resuming from seq {sent}")
 
-            try:
-                conn.sendall(b"\x06")
-            except Exception:
-                pass
+        t = threading.Thread(target=_read_acks, args=(link, name, peer_id), daemon=True)
+        t.start()
 
+        while t.is_alive():
+            entries = repl_log_read(sent)
+            if entries:
+                link.send_many(entries)
+                sent = entries[-1]["seq"]
+                continue
+            with REPL_COND:
+                REPL_COND.wait_for(lambda: REPL_SEQ > sent or name not in REPL_STANDBYS,
+                                   REPLICATION_PING_INTERVAL)
+                idle = REPL_SEQ <= sent
+            if idle:
+                link.send({"op": "ping", "seq": sent})
+    except Exception as e:
+        print(f"[IPRO12] Replication: standby {name} error:", e)
+    finally:
+        with REPL_COND:
+            REPL_STANDBYS.pop(name, None)
+            REPL_COND.notify_all()
+        conn.close()
+        if registered:
+            print(f"[IPRO12] Replication: standby {name} disconnected")
+
+
+def apply_replicated(entry):
+    global REPL_APPLIED
+    if entry.get("origin") == INSTANCE_ID:
+        # our own uplinked frame coming back; it is already archived here
+        event = None
+    else:
+        event = entry["event"]
+    with DB_LOCK:
+        cur = DB_CONN.cursor()
+        try:
+            if event is not None:
+                # not in this instance's journal, so the archive keeps the frame
+                _insert_event(cur, entry["ts_ms"], event, replicated=True, keep_raw=True)
+            meta_set(cur, "primary_seq", entry["seq"])
+            DB_CONN.commit()
+        except Exception:
+            db_rollback()
+            raise
+        if event is not None:
+            data_changed()
+    REPL_APPLIED = entry["seq"]
+    if event is not None and entry["kind"] == "event":
+        update_states_from_event(event)
+
+
+def apply_snapshot(primary_id, seq, rows, uplinked):
+    """Replace everything this standby holds from the primary.
+
+    Drops rows replicated earlier and local rows already uplinked (the
+    snapshot contains both), keeps local history the primary never saw.
+    Rows from a different, earlier primary (rebuilt database) are kept
+    as local history rather than lost with it.
+    """
+    global REPL_APPLIED, REPL_PRIMARY_ID
+    with DB_LOCK:
+        cur = DB_CONN.cursor()
+        try:
+            if REPL_PRIMARY_ID is not None and REPL_PRIMARY_ID != primary_id:
+                cur.execute("UPDATE events SET replicated = NULL WHERE replicated = 1;")
+            cur.execute(
+                "DELETE FROM events WHERE replicated = 1 OR id IN "
+                "(SELECT event_id FROM replication_log WHERE seq <= ?);",
+                (uplinked,),
+            )
+            for row in rows:
+                _insert_event(cur, row["ts_ms"], row["event"], replicated=True, keep_raw=True)
+            meta_set(cur, "primary_id", primary_id)
+            meta_set(cur, "primary_seq", seq)
+            DB_CONN.commit()
+        except Exception:
+            db_rollback()
+            raise
+        data_changed()
+    REPL_APPLIED = seq
+    REPL_PRIMARY_ID = primary_id
+    for row in rows:
+        update_states_from_event(row["event"])
+    print(f"[IPRO12] Replication: snapshot of {len(rows)} events from {primary_id} applied at seq {seq}")
+
+
+def repl_push_uplink(link, after_seq):
+    while True:
+        entries = repl_log_read(after_seq)
+        if not entries:
+            return after_seq
+        for e in entries:
+            e["op"] = "uplink"
+        link.send_many(entries)
+        after_seq = entries[-1]["seq"]
+
+
+def replication_client():
+    if not REPLICATION_SECRET:
+        print("[IPRO12] Replication: replication_secret is not set, standby disabled")
+        return
+    if not REPLICATION_PRIMARY:
+        print("[IPRO12] Replication: replication_primary is not set, standby disabled")
+        return
+    if DB_CONN is None:
+        print("[IPRO12] Replication: archive is disabled, standby disabled")
+        return
+    host, _, port = REPLICATION_PRIMARY.rpartition(":")
+    if not host:
+        host, port = REPLICATION_PRIMARY, REPLICATION_PORT
+    while True:
+        conn = None
+        try:
+            conn = socket.create_connection((host, int(port)), timeout=10)
+            conn.settimeout(REPLICATION_PING_INTERVAL * 3)
+            link = ReplLink(conn, "standby", "primary")
+            challenge = link.read()
+            if challenge.get("op") != "challenge":
+                raise ConnectionError("no challenge from primary")
+            nonce = str(challenge["nonce"])
+            # our own nonce, so a recorded welcome cannot be replayed to us
+            my_nonce = uuid.uuid4().hex
+            link.send({
+                "op": "hello",
+                "id": INSTANCE_ID,
+                "primary_id": REPL_PRIMARY_ID,
+                "from_seq": REPL_APPLIED,
+                "nonce": my_nonce,
+                "auth": _repl_auth(nonce, my_nonce, "standby", INSTANCE_ID),
+            })
+            welcome = link.read()
+            primary_id = str(welcome.get("primary_id", ""))
+            if welcome.get("op") != "welcome" or not hmac.compare_digest(
+                str(welcome.get("auth", "")), _repl_auth(nonce, my_nonce, "primary", primary_id)
+            ):
+                metric_inc("replication_auth_failures")
+                raise ConnectionError("primary failed authentication")
+            link.secure(nonce, my_nonce)
+            uplinked = repl_push_uplink(link, max(int(welcome.get("uplink_seq", 0)), REPL_UPLINK_FLOOR))
+            link.send({"op": "ready", "uplinked": uplinked})
+            print(f"[IPRO12] Replication: connected to primary {primary_id} at {host}:{port}, seq {REPL_APPLIED}")
+
+            snapshot = None
+            while True:
+                msg = link.read()
+                op = msg.get("op")
+                if op == "snapshot_begin":
+                    snapshot = []
+                elif op == "snapshot_row":
+                    snapshot.append(msg)
+                    if len(snapshot) % 1000 == 0:
+                        # keep the primary's read timeout from expiring
+                        link.send({"op": "ack", "seq": REPL_APPLIED})
+                    continue
+                elif op == "snapshot_end":
+                    apply_snapshot(primary_id, int(msg["seq"]), snapshot, uplinked)
+                    snapshot = None
+                elif op == "entry" and msg["seq"] > REPL_APPLIED:
+                    apply_replicated(msg)
+                if snapshot is None:
+                    link.send({"op": "ack", "seq": REPL_APPLIED})
+                    uplinked = repl_push_uplink(link, uplinked)
         except Exception as e:
-            print("[IPRO12] Error handling connection:", e)
+            print("[IPRO12] Replication: primary link error:", e)
         finally:
-            conn.close()
+            if conn is not None:
+                conn.close()
+        time.sleep(2)
+
+
+def replication_status():
+    with REPL_COND:
+        return {
+            "role": REPLICATION_ROLE,
+            "instance_id": INSTANCE_ID,
+            "primary_id": REPL_PRIMARY_ID,
+            "seq": REPL_SEQ,
+            "applied": REPL_APPLIED,
+            "standbys": {name: dict(st) for name, st in REPL_STANDBYS.items()},
+        }
 
 
-if __name__ == "__main__":
+def replay_capture(path=CAPTURE_PATH, speed=1.0, start_ms=None, end_ms=None,
+                   dispatch=False, archive=False):
+    """Feed captured frames back through the parser and, optionally, the
+    dispatch pipeline (MQTT, webhook) and the archive.
+
+    speed is a multiplier of the recorded pacing (1 = real time,
+    0 = as fast as possible). Frames whose parse result differs from
+    the recorded one are reported. Archived rows keep the recorded time.
+    """
+    count = 0
+    mismatches = 0
+    prev_ts = None
+    for fname in capture_files(path):
+        with CaptureReader(fname) as reader:
+            for rec in reader.records(start_ms, end_ms):
+                if speed > 0 and prev_ts is not None:
+                    delay = (rec["ts_ms"] - prev_ts) / 1000.0 / speed
+                    if delay > 0:
+                        time.sleep(delay)
+                prev_ts = rec["ts_ms"]
+
+                event = parse_contact_id(rec["raw"].decode(errors="ignore"))
+                if event != rec["parsed"]:
+                    mismatches += 1
+                    ts = datetime.utcfromtimestamp(rec["ts_ms"] / 1000.0).isoformat(timespec="milliseconds")
+                    print(f"[IPRO12] Replay mismatch at {ts} from {rec['peer']}: {repr(rec['raw'])}")
+                    print("[IPRO12]   recorded:", rec["parsed"])
+                    print("[IPRO12]   now:     ", event)
+                if event and dispatch:
+                    dispatch_event(event, ts_ms=rec["ts_ms"])
+                elif event and archive:
+                    save_event_to_db(event, ts_ms=rec["ts_ms"])
+                count += 1
+    print(f"[IPRO12] Replayed {count} frames, {mismatches} parse mismatches")
+    return count
+
+
+def _parse_ts_ms(value):
+    if value is None:
+        return None
+    if value.isdigit():
+        return int(value)
+    ts = datetime.fromisoformat(value)
+    if ts.tzinfo is None:
+        # journal, /history and replay output are all UTC
+        ts = ts.replace(tzinfo=timezone.utc)
+    return int(ts.timestamp() * 1000)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="IPRO12 Surgard Receiver")
+    sub = parser.add_subparsers(dest="command")
+    rp = sub.add_parser("replay", help="replay a capture journal")
+    rp.add_argument("path", nargs="?", default=CAPTURE_PATH)
+    rp.add_argument("--speed", type=float, default=1.0,
+                    help="pacing multiplier, 0 = no delay (default 1)")
+    rp.add_argument("--from", dest="start", help="start time, ISO (UTC unless offset given) or epoch ms")
+    rp.add_argument("--to", dest="end", help="end time, ISO (UTC unless offset given) or epoch ms")
+    rp.add_argument("--dispatch", action="store_true",
+                    help="also publish replayed events to MQTT / webhook (live broker!)")
+    rp.add_argument("--archive", action="store_true",
+                    help="also write replayed events to the SQLite archive")
+    args = parser.parse_args(argv)
+
+    if args.command == "replay":
+        if args.archive:
+            init_db()
+        replay_capture(
+            args.path,
+            speed=args.speed,
+            start_ms=_parse_ts_ms(args.start),
+            end_ms=_parse_ts_ms(args.end),
+            dispatch=args.dispatch,
+            archive=args.archive,
+        )
+        return
+
     init_db()
+    init_capture()
+    atexit.register(close_capture)
+    signal.signal(signal.SIGTERM, handle_sigterm)
 
     t_http = threading.Thread(target=start_http_server, daemon=True)
     t_http.start()
@@ -759,4 +2123,18 @@ if __name__ == "__main__":
     t_sup = threading.Thread(target=supervision_watchdog, daemon=True)
     t_sup.start()
 
+    t_cap = threading.Thread(target=capture_flush_loop, daemon=True)
+    t_cap.start()
+
+    if REPLICATION_ROLE == "primary":
+        t_repl = threading.Thread(target=start_replication_server, daemon=True)
+        t_repl.start()
+    elif REPLICATION_ROLE == "standby":
+        t_repl = threading.Thread(target=replication_client, daemon=True)
+        t_repl.start()
+
     start_surgard_server()
+
+
+if __name__ == "__main__":
+    main()